@@ -1,9 +1,30 @@
 import os
-import random
+import re
+import json
+import atexit
+import ssl
+import time
+import queue
+import hashlib
+import functools
+import datetime
+import pathlib
+import sqlite3
+import itertools
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import threading
+from collections import OrderedDict
+from contextlib import closing
+from concurrent.futures import Future, ThreadPoolExecutor
+import ahocorasick
+import numpy as np
 from slack_bolt import App
 from slack_bolt.adapter.flask import SlackRequestHandler
-from flask import Flask, request
+from slack_sdk import WebClient
+from slack_sdk.http_retry import ConnectionErrorRetryHandler, RateLimitErrorRetryHandler
+from flask import Flask, Response, request
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
 import google.generativeai as genai
 
 # --- 환경 변수 체크 ---
@@ -14,16 +35,48 @@ for key in required_env:
         exit()
 
 # --- 로깅 설정 ---
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s',
-                    handlers=[logging.StreamHandler()])
+# 로그 포맷팅과 출력은 QueueListener 스레드가 맡아, 이벤트 처리 스레드는 큐에 넣기만 하고 바로 돌아갑니다.
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_queue_handler = QueueHandler(queue.Queue(-1))
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+log_listener = QueueListener(log_queue_handler.queue, log_stream_handler)
+log_listener.start()
+logging.basicConfig(level=logging.INFO, handlers=[log_queue_handler])
 logger = logging.getLogger(__name__)
 
+def restart_log_listener():
+    """fork된 워커에는 리스너 스레드가 없으므로 새 큐와 리스너를 만듭니다."""
+    global log_listener
+    log_queue_handler.queue = queue.Queue(-1)
+    log_listener = QueueListener(log_queue_handler.queue, log_stream_handler)
+    log_listener.start()
+
+os.register_at_fork(after_in_child=restart_log_listener)
+# 종료 시 큐에 남은 로그를 마저 출력합니다.
+atexit.register(lambda: log_listener.stop())
+
 # --- 앱 초기화 ---
 try:
-    app = App(
+    # 슬랙 SDK는 urllib으로 요청마다 연결을 새로 열기 때문에, 최소한 SSL 컨텍스트(CA 인증서 로딩)는 재사용합니다.
+    slack_ssl_context = ssl.create_default_context()
+    slack_client = WebClient(token=os.environ.get("SLACK_BOT_TOKEN"), ssl=slack_ssl_context)
+    # 최종 답변 게시에만 쓰는 클라이언트입니다. 429(요청 한도 초과)를 받으면 Retry-After만큼 기다렸다가 다시 보내,
+    # 답변이 중간 결과로 남지 않도록 합니다. (스트리밍 중간 갱신은 기다리지 않고 바로 실패하도록 기본 클라이언트 사용)
+    final_update_client = WebClient(
         token=os.environ.get("SLACK_BOT_TOKEN"),
-        signing_secret=os.environ.get("SLACK_SIGNING_SECRET")
+        ssl=slack_ssl_context,
+        retry_handlers=[ConnectionErrorRetryHandler(), RateLimitErrorRetryHandler(max_retry_count=2)]
+    )
+    # Bolt는 Events API 요청에 바로 200(ack)을 응답하고, 리스너는 이 스레드 풀에서 따로 실행합니다.
+    # Gemini 호출이 몇 초씩 걸리므로 동시에 처리할 메시지 수를 기본값(10)보다 넉넉히 잡습니다.
+    listener_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("LISTENER_WORKERS", 16)))
+    app = App(
+        client=slack_client,
+        signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
+        listener_executor=listener_executor,
+        # 시작할 때 auth_test로 토큰을 확인하지 않습니다. (봇 ID는 load_bot_id가 캐시에서 가져오고, 인증 정보는 첫 요청 때 확인)
+        token_verification_enabled=False
     )
     flask_app = Flask(__name__)
     handler = SlackRequestHandler(app)
@@ -32,71 +85,17 @@ except Exception as e:
     logger.critical(f"앱 초기화 실패: {e}")
     exit()
 
-# --- 메인 봇 클래스 ---
-class PeopleAIBot:
-    def __init__(self):
-        try:
-            self.bot_id = app.client.auth_test()['user_id']
-            logger.info(f"봇 ID({self.bot_id})를 성공적으로 가져왔습니다.")
-        except Exception as e:
-            logger.error(f"봇 ID 가져오기 실패: {e}")
-            self.bot_id = None
-
-        self.gemini_model = self.setup_gemini()
-        self.knowledge_base = self.load_knowledge_file()
-        self.help_text = self.load_help_file()
-        self.responses = { "searching": ["잠시만요, 관련 정보를 찾고 있어요... 🕵️‍♀️", "생각하는 중... 🤔"] }
-        self.setup_direct_answers()
-
-    def setup_direct_answers(self):
-        """AI를 거치지 않고 즉시 답변할 특정 질문과 답변을 설정합니다."""
-        self.direct_answers = [
-            {
-                "keywords": ["외부 회의실", "외부회의실", "스파크플러스 예약", "4층 회의실"],
-                "answer": """피플팀에서 예약 가능 여부를 확인한 후, 이 스레드로 답변을 드릴게요. (@시현빈, @박지영)"""
-            }
-        ]
-        logger.info("특정 질문에 대한 직접 답변(치트키) 설정 완료.")
-
-    def setup_gemini(self):
-        try:
-            gemini_api_key = os.environ.get("GEMINI_API_KEY")
-            genai.configure(api_key=gemini_api_key)
-            model = genai.GenerativeModel("gemini-2.5-flash")
-            logger.info("Gemini API 활성화 완료.")
-            return model
-        except Exception as e:
-            logger.error(f"Gemini 모델 설정 실패: {e}")
-            return None
-
-    def load_knowledge_file(self):
-        try:
-            with open("guide_data.txt", 'r', encoding='utf-8') as f:
-                return f.read()
-        except FileNotFoundError:
-            logger.error("'guide_data.txt' 파일을 찾을 수 없습니다.")
-            return ""
-
-    def load_help_file(self):
-        try:
-            with open("help.md", 'r', encoding='utf-8') as f:
-                return f.read()
-        except FileNotFoundError:
-            logger.error("'help.md' 파일을 찾을 수 없습니다.")
-            return "도움말 파일을 찾을 수 없습니다."
-
-    def generate_answer(self, query):
-        for item in self.direct_answers:
-            for keyword in item["keywords"]:
-                if keyword in query:
-                    logger.info(f"'{keyword}' 키워드를 감지하여 지정된 답변을 반환합니다.")
-                    return item["answer"]
-
-        if not self.gemini_model: return "AI 모델이 설정되지 않아 답변할 수 없습니다."
-        if not self.knowledge_base: return "지식 파일이 비어있어 답변할 수 없습니다."
-        
-        # *** 수정된 부분: 모든 답변 예시를 프롬프트에 포함 ***
-        prompt = f"""
+# --- 메트릭 ---
+# gunicorn 워커가 여러 개일 때는 PROMETHEUS_MULTIPROC_DIR을 지정해야 /metrics가 모든 워커의 값을 합산합니다.
+# 답변 한 건을 기다린 시간입니다. 묶음 처리(GEMINI_BATCH_WINDOW_MS)를 쓰면 묶음 대기 시간도 포함됩니다.
+# outcome: success(정상), empty(빈 응답), error(실패·시간 초과), circuit_open(차단되어 바로 실패)
+GEMINI_LATENCY = Histogram("gemini_latency_seconds", "Gemini 답변 생성 시간(초)", ["outcome"],
+                           buckets=(.25, .5, 1, 2, 5, 10, 30))
+ANSWER_CACHE_REQUESTS = Counter("answer_cache_requests_total", "답변 캐시 조회 결과", ["result"])
+
+# --- 프롬프트 템플릿 ---
+# 역할, 원칙, 답변 예시는 요청마다 변하지 않으므로 지식 파일과 함께 한 번만 조립합니다.
+PROMPT_HEADER = """
 [당신의 역할]
 당신은 '중고나라' 회사의 피플팀 AI 어시스턴트 '피플AI'입니다. 당신의 임무는 동료의 질문에 명확하고 간결하며, 가독성 높은 답변을 제공하는 것입니다.
 
@@ -378,26 +377,958 @@ https://joonggonara.atlassian.net/wiki/spaces/SREv2/pages/4743954479
 
 ---
 [참고 자료]
-{self.knowledge_base}
----
-[질문]
-{query}
-[답변]
 """
+PROMPT_QUESTION_HEADER = "\n---\n[질문]\n"
+PROMPT_ANSWER_HEADER = "\n[답변]\n"
+
+# 사용할 Gemini 모델 (배포 환경별로 코드 수정 없이 바꿀 수 있습니다)
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
+# 설정하면(예: gemini-2.5-flash-lite) 본 답변 전에 이 가벼운 모델로 업무 관련 질문인지 먼저 판단합니다.
+GEMINI_CLASSIFIER_MODEL = os.environ.get("GEMINI_CLASSIFIER_MODEL", "")
+PROMPT_CLASSIFIER = """다음 메시지가 회사 생활(인사, 복지, 근태, 사무실 이용 등)에 대해 피플팀에 묻는 질문이면 Y, 인사말이나 잡담처럼 답할 필요가 없는 메시지면 N 한 글자로만 답하세요.
+메시지: """
+OFF_TOPIC_ANSWER = "피플팀 업무에 대해 궁금한 점을 물어봐 주시면 찾아서 알려드릴게요! 🙂"
+# 분류는 한 글자 답이라 금방 끝나야 합니다. 이보다 오래 걸리면 분류 없이 본 답변으로 넘어갑니다.
+GEMINI_CLASSIFIER_TIMEOUT = 5
+
+# 지식 파일/도움말 파일 수정 여부를 확인하는 최소 간격(초)
+KNOWLEDGE_CHECK_INTERVAL = int(os.environ.get("KNOWLEDGE_CHECK_INTERVAL", 60))
+# 프롬프트에 넣을 지식 파일의 최대 토큰 수. 넘으면 "## " 섹션 단위로 예산 안에 드는 만큼만 넣습니다. 0이면 자르지 않습니다.
+KNOWLEDGE_TOKEN_BUDGET = int(os.environ.get("KNOWLEDGE_TOKEN_BUDGET", 800000))
+
+def get_file_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+@functools.lru_cache(maxsize=2)
+def read_text_file(path, mtime):
+    """파일 내용을 읽습니다. (경로, 수정 시각)이 같으면 디스크를 다시 읽지 않습니다."""
+    return pathlib.Path(path).read_text(encoding='utf-8')
+
+# --- 검색 증강(RAG) 설정 ---
+# RETRIEVAL_TOP_K가 0이면 지식 파일 전체를 프롬프트에 넣습니다.
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", 0))
+EMBEDDING_MODEL = "models/text-embedding-004"
+# 질문 하나를 임베딩하는 호출에 허용하는 최대 시간(초)
+EMBEDDING_TIMEOUT = 5
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 100
+# 임베딩 결과를 저장해 두는 폴더. 지식 파일이 그대로면 재시작 시 임베딩 API를 다시 부르지 않습니다.
+INDEX_CACHE_DIR = ".cache"
+
+def split_into_chunks(text, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """지식 파일을 앞뒤가 조금씩 겹치는 일정 길이의 조각으로 나눕니다."""
+    step = size - overlap
+    return [text[i:i + size] for i in range(0, max(len(text) - overlap, 1), step)]
+
+# auth_test로 가져온 봇 ID를 저장해 두는 파일 (SLACK_BOT_ID 환경 변수가 우선)
+# 토큰 해시를 파일 이름에 넣어, 토큰이 바뀌면 다른 봇의 ID를 재사용하지 않도록 합니다.
+BOT_ID_CACHE_FILE = os.path.join(
+    INDEX_CACHE_DIR,
+    f"bot_id_{hashlib.sha256(os.environ['SLACK_BOT_TOKEN'].encode('utf-8')).hexdigest()[:16]}",
+)
+# 캐시된 봇 ID를 믿고 쓰는 기간(초). 지나면 auth_test로 다시 확인합니다.
+BOT_ID_CACHE_TTL = 30 * 24 * 3600
+
+# --- Gemini 컨텍스트 캐시 ---
+# 역할·원칙·예시와 지식 파일을 Gemini 서버에 캐시해 두는 시간(초). 0이면 매 요청 전체 프롬프트를 보냅니다.
+GEMINI_CACHE_TTL = int(os.environ.get("GEMINI_CACHE_TTL", 3600))
+
+# --- 답변 캐시 ---
+ANSWER_CACHE_SIZE = 512
+# 답변 캐시를 저장하는 SQLite 파일. 재시작 후에도, 여러 워커 사이에서도 캐시를 이어 씁니다. 빈 값이면 메모리에만 둡니다.
+ANSWER_CACHE_PATH = os.environ.get("ANSWER_CACHE_PATH", ".cache/answers.sqlite3")
+# 0보다 크면 임베딩 코사인 유사도가 이 값 이상인 이전 질문의 답변을 재사용합니다.
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0))
+
+USER_MENTION_PATTERN = re.compile(r"<@[A-Z0-9]+>")
+
+def normalize_query(query):
+    """대소문자, 공백, 사용자 멘션 차이만 있는 질문을 같은 캐시 키로 모읍니다."""
+    return " ".join(USER_MENTION_PATTERN.sub(" ", query).lower().split())
+
+class AnswerCache:
+    """지식 파일 버전별로 질문-답변을 최대 maxsize개까지 기억하는 LRU 캐시입니다. path가 있으면 디스크에도 저장합니다."""
+    def __init__(self, maxsize, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self._answers = OrderedDict()
+        self._vectors = {}
+        self._lock = threading.Lock()
+        if self.path:
+            self._init_db()
+
+    def get(self, key):
+        with self._lock:
+            answer = self._answers.get(key)
+            if answer is not None:
+                self._answers.move_to_end(key)
+                return answer
+        answer = self._load(key)
+        if answer is not None:
+            with self._lock:
+                self._answers[key] = answer
+                self._trim()
+        return answer
+
+    def find_similar(self, knowledge_hash, vector, threshold):
+        """같은 지식 파일 버전에서 임베딩이 가장 비슷한 질문의 답변을 찾습니다."""
+        with self._lock:
+            best_key, best_score = None, threshold
+            for key, cached_vector in self._vectors.items():
+                if key[0] != knowledge_hash:
+                    continue
+                score = float(np.dot(vector, cached_vector))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                return None
+            self._answers.move_to_end(best_key)
+            return self._answers[best_key]
+
+    def set(self, key, answer, vector=None):
+        with self._lock:
+            self._answers[key] = answer
+            self._answers.move_to_end(key)
+            if vector is not None:
+                self._vectors[key] = vector
+            self._trim()
+        self._store(key, answer)
+
+    def _trim(self):
+        while len(self._answers) > self.maxsize:
+            old_key, _ = self._answers.popitem(last=False)
+            self._vectors.pop(old_key, None)
+
+    def _init_db(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with closing(sqlite3.connect(self.path, timeout=5)) as conn, conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS answers ("
+                             "knowledge_hash TEXT, query TEXT, answer TEXT, PRIMARY KEY (knowledge_hash, query))")
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"답변 캐시 파일을 열 수 없어 메모리 캐시만 사용합니다: {e}")
+            self.path = None
+
+    def _load(self, key):
+        if not self.path:
+            return None
+        try:
+            # 연결은 요청마다 새로 엽니다. (fork된 워커끼리 연결을 공유하지 않도록)
+            with closing(sqlite3.connect(self.path, timeout=5)) as conn:
+                row = conn.execute("SELECT answer FROM answers WHERE knowledge_hash = ? AND query = ?", key).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"답변 캐시 파일 조회 실패: {e}")
+            return None
+        return row[0] if row else None
+
+    def _store(self, key, answer):
+        if not self.path:
+            return
+        try:
+            with closing(sqlite3.connect(self.path, timeout=5)) as conn, conn:
+                conn.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?)", (*key, answer))
+                conn.execute("DELETE FROM answers WHERE rowid NOT IN "
+                             "(SELECT rowid FROM answers ORDER BY rowid DESC LIMIT ?)", (self.maxsize,))
+        except sqlite3.Error as e:
+            logger.warning(f"답변 캐시 파일 저장 실패: {e}")
+
+    def prune(self, knowledge_hash):
+        """현재 knowledge_hash가 아닌 답변을 디스크에서 지웁니다. 지식 파일을 새로 읽은 프로세스만 호출합니다."""
+        if not self.path:
+            return
+        try:
+            with closing(sqlite3.connect(self.path, timeout=5)) as conn, conn:
+                conn.execute("DELETE FROM answers WHERE knowledge_hash != ?", (knowledge_hash,))
+        except sqlite3.Error as e:
+            logger.warning(f"답변 캐시 파일 정리 실패: {e}")
+
+# --- Gemini 장애 대응 ---
+# 한 번의 Gemini 호출에 허용하는 최대 시간(초)
+GEMINI_TIMEOUT = int(os.environ.get("GEMINI_TIMEOUT", 30))
+GEMINI_BREAKER_FAIL_MAX = 5
+GEMINI_BREAKER_RESET_TIMEOUT = 30
+
+class CircuitOpenError(Exception):
+    """회로 차단기가 열려 있어 호출을 시도하지 않았을 때 발생합니다."""
+
+class CircuitBreaker:
+    """연속 실패가 쌓이면 일정 시간 동안 호출을 막아, 장애 중에는 기다리지 않고 바로 실패합니다."""
+    def __init__(self, fail_max, reset_timeout, name="Gemini"):
+        self.name = name
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        with self._lock:
+            if self._opened_at is not None:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"{self.name} 회로 차단기가 열려 있습니다.")
+                # 대기 시간이 지나면 한 번만 시험 호출을 허용하고, 나머지는 계속 차단합니다.
+                self._opened_at = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self._failures += 1
+                if self._failures >= self.fail_max:
+                    if self._opened_at is None:
+                        logger.warning(f"{self.name} 호출이 {self._failures}회 연속 실패하여 {self.reset_timeout}초간 차단합니다.")
+                    self._opened_at = time.monotonic()
+            raise
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"{self.name} 호출이 복구되어 회로 차단기를 닫습니다.")
+            self._failures = 0
+            self._opened_at = None
+        return result
+
+# Gemini 평균 응답 시간(초)이 이보다 짧으면 대기 메시지 없이 답변을 한 번에 게시합니다.
+FAST_ANSWER_THRESHOLD = 1.0
+# 응답 시간 지수이동평균(EWMA)에서 최신 측정값의 비중
+LATENCY_EWMA_ALPHA = 0.2
+
+# --- 묶음 처리(마이크로 배칭) ---
+# 이 시간(ms) 안에 몰린 질문을 한 번의 Gemini 호출로 묶습니다. (150 정도 권장) 0이면 사용하지 않습니다.
+GEMINI_BATCH_WINDOW_MS = int(os.environ.get("GEMINI_BATCH_WINDOW_MS", 0))
+GEMINI_BATCH_MAX_SIZE = 8
+PROMPT_BATCH_INSTRUCTION = "아래 질문들은 서로 다른 동료가 보낸 것입니다. 각 질문에 독립적으로 답변하고, 질문 번호 순서대로 답변 문자열만 담은 JSON 배열로 응답해주세요.\n"
+# 묶음 응답은 JSON으로만 받아 답변 경계가 흐트러지지 않도록 합니다.
+BATCH_GENERATION_CONFIG = {"response_mime_type": "application/json"}
+
+def split_batch_answers(text):
+    """JSON 배열 형식의 묶음 응답을 {번호: 답변} 딕셔너리로 나눕니다. 형식이 맞지 않으면 빈 딕셔너리를 반환합니다."""
+    try:
+        answers = json.loads(text)
+    except ValueError:
+        logger.warning("묶음 응답이 JSON 형식이 아니어서 개별 호출로 전환합니다.")
+        return {}
+    if not isinstance(answers, list):
+        return {}
+    return {number: answer.strip() for number, answer in enumerate(answers, 1)
+            if isinstance(answer, str) and answer.strip()}
+
+class GeminiBatcher:
+    """짧은 시간 안에 몰린 질문들을 모아 한 번의 Gemini 호출로 답변합니다."""
+    def __init__(self, bot, window, max_size=GEMINI_BATCH_MAX_SIZE):
+        self.bot = bot
+        self.window = window
+        self.max_size = max_size
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max_size)
+        # 묶음에서 빠진 질문을 다시 물어보는 호출은 따로 병렬로 돌립니다.
+        self._fallback_executor = ThreadPoolExecutor(max_workers=max_size)
+        # 묶음 호출과 개별 재호출이 모두 시간 초과까지 걸리는 경우보다 조금 더 기다립니다.
+        self.result_timeout = window + 2 * GEMINI_TIMEOUT + 5
+        self._collector = None
+        self._lock = threading.Lock()
+
+    def submit(self, query):
+        """질문을 대기열에 넣고 답변이 나올 때까지 기다립니다. 너무 오래 걸리면 TimeoutError가 발생합니다."""
+        self._ensure_collector()
+        future = Future()
+        self._queue.put((query, future))
+        return future.result(timeout=self.result_timeout)
+
+    def _ensure_collector(self):
+        # 수집 스레드는 fork 이후 워커에서 처음 사용될 때 시작합니다.
+        if self._collector and self._collector.is_alive():
+            return
+        with self._lock:
+            if not (self._collector and self._collector.is_alive()):
+                self._collector = threading.Thread(target=self._collect, daemon=True)
+                self._collector.start()
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch):
+        answers = {}
+        if len(batch) > 1:
+            try:
+                answers = self.bot.answer_batch([query for query, _ in batch])
+            except Exception as e:
+                logger.error(f"묶음 Gemini 호출 실패, 개별 호출로 전환합니다: {e}")
+        # 묶음 응답에서 빠진 질문은 개별로 다시 물어봅니다. (앞 질문의 호출을 기다리지 않도록 병렬로)
+        for number, (query, future) in enumerate(batch, 1):
+            if number in answers:
+                future.set_result(answers[number])
+            else:
+                self._fallback_executor.submit(self._answer_one, query, future)
+
+    def _answer_one(self, query, future):
+        try:
+            future.set_result(self.bot.call_gemini(*self.bot.build_request(query)))
+        except Exception as e:
+            future.set_exception(e)
+
+# --- 메인 봇 클래스 ---
+class PeopleAIBot:
+    def __init__(self):
+        self.bot_id = self.load_bot_id()
+        # 멘션 토큰은 메시지마다 만들지 않고 한 번만 만들어 둡니다.
+        self.mention_tag = f"<@{self.bot_id}>" if self.bot_id else None
+        self.mention_pattern = re.compile(re.escape(self.mention_tag)) if self.mention_tag else None
+
+        self.gemini_model = self.setup_gemini()
+        self.classifier_model = self.build_classifier_model()
+        self.breaker = CircuitBreaker(GEMINI_BREAKER_FAIL_MAX, GEMINI_BREAKER_RESET_TIMEOUT)
+        # 보조 호출은 차단기를 따로 둡니다. (보조 모델 장애가 본 답변까지 막지 않도록)
+        self.classifier_breaker = CircuitBreaker(GEMINI_BREAKER_FAIL_MAX, GEMINI_BREAKER_RESET_TIMEOUT, "질문 분류")
+        self.embedding_breaker = CircuitBreaker(GEMINI_BREAKER_FAIL_MAX, GEMINI_BREAKER_RESET_TIMEOUT, "질문 임베딩")
+        self.gemini_latency_ewma = None
+        self._knowledge_lock = threading.Lock()
+        self._knowledge_checked_at = time.monotonic()
+        self.knowledge_mtime = get_file_mtime("guide_data.txt")
+        self.knowledge_base = self.load_knowledge_file()
+        self._kb_for_prompt = self.trim_knowledge_for_prompt(self.knowledge_base)
+        self._prompt_prefix = self.build_prompt_prefix(self._kb_for_prompt)
+        self.knowledge_index = self.build_knowledge_index(self.knowledge_base)
+        self._prompt_cache_lock = threading.Lock()
+        # (서버 캐시, 캐시를 쓰는 모델)을 한 속성에 두어, 읽는 쪽이 항상 짝이 맞는 값을 한 번에 가져가도록 합니다.
+        self._prompt_cache_state = (None, None)
+        self._prompt_cache_pid = None
+        self.setup_prompt_cache()
+        self.knowledge_hash = self.hash_knowledge(self.knowledge_base, self._kb_for_prompt)
+        self.help_mtime = get_file_mtime("help.md")
+        self.help_text = self.load_help_file()
+        self.answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_PATH)
+        self.answer_cache.prune(self.knowledge_hash)
+        self.batcher = GeminiBatcher(self, GEMINI_BATCH_WINDOW_MS / 1000) if GEMINI_BATCH_WINDOW_MS > 0 else None
+        self.responses = { "searching": ["잠시만요, 관련 정보를 찾고 있어요... 🕵️‍♀️", "생각하는 중... 🤔"] }
+        # 대기 문구는 무작위일 필요가 없어 순서대로 돌려 씁니다.
+        self._searching_cycle = itertools.cycle(self.responses['searching'])
+        self.setup_direct_answers()
+
+    def load_bot_id(self):
+        """봇 ID를 환경 변수, 캐시 파일, auth_test 순서로 가져옵니다. (콜드 스타트 시 슬랙 API 호출 생략)"""
+        bot_id = os.environ.get("SLACK_BOT_ID")
+        if bot_id:
+            return bot_id
+        try:
+            if time.time() - os.path.getmtime(BOT_ID_CACHE_FILE) < BOT_ID_CACHE_TTL:
+                with open(BOT_ID_CACHE_FILE, 'r', encoding='utf-8') as f:
+                    bot_id = f.read().strip()
+                if bot_id:
+                    logger.info(f"캐시된 봇 ID({bot_id})를 사용합니다.")
+                    return bot_id
+        except FileNotFoundError:
+            pass
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning(f"봇 ID 캐시 파일을 읽을 수 없어 슬랙에서 다시 가져옵니다: {e}")
+        try:
+            bot_id = app.client.auth_test()['user_id']
+            logger.info(f"봇 ID({bot_id})를 성공적으로 가져왔습니다.")
+        except Exception as e:
+            logger.error(f"봇 ID 가져오기 실패: {e}")
+            return None
+        try:
+            os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+            with open(BOT_ID_CACHE_FILE, 'w', encoding='utf-8') as f:
+                f.write(bot_id)
+        except OSError as e:
+            logger.warning(f"봇 ID 캐시 파일 저장 실패: {e}")
+        return bot_id
+
+    def setup_direct_answers(self):
+        """AI를 거치지 않고 즉시 답변할 특정 질문과 답변을 설정합니다."""
+        # 와이파이·복합기는 주제 단어만으로는 고장 문의까지 걸리므로, 정해진 안내로 답할 수 있는 조회 표현만 등록합니다.
+        wifi_keywords = [f"{name}{sep}{word}" for name in ("와이파이", "wifi", "wi-fi") for sep in ("", " ")
+                         for word in ("비밀번호", "비번", "pw", "password", "연결 방법", "연결방법", "접속 방법", "접속방법")]
+        printer_keywords = [f"복합기{sep}{word}" for sep in ("", " ")
+                            for word in ("계정", "등록", "설정", "사용 방법", "사용방법", "사용법", "인증카드", "프로그램 설치")]
+        self.direct_answers = [
+            {
+                "keywords": ["외부 회의실", "외부회의실", "스파크플러스 예약", "4층 회의실"],
+                "answer": """피플팀에서 예약 가능 여부를 확인한 후, 이 스레드로 답변을 드릴게요. (@시현빈, @박지영)"""
+            },
+            {
+                "keywords": wifi_keywords,
+                "answer": """사무실 Wi-Fi 연결 방법을 안내해 드릴게요.
+
+⚠️ 업무용 Wi-Fi는 목록에 표시되지 않는 '히든(Hidden) 네트워크' 방식이에요.
+따라서 직접 네트워크 정보를 입력해서 연결해야 합니다.
+
+📶 [직원용 Wi-Fi]
+네트워크 이름(SSID): joonggonara-5G
+비밀번호: jn2023!@
+
+🔄 [연결 방법]
+Wi-Fi 설정에서 '숨겨진 네트워크' 또는 '기타...'를 선택해주세요.
+위 네트워크 이름과 비밀번호를 직접 입력하면 연결할 수 있어요.
+
+🔗 [운영체제별 상세 가이드]
+Windows, MacOS, 모바일 상세 설정 방법은 아래 링크를 확인해주세요.
+https://joonggonara.atlassian.net/wiki/spaces/SREv2/pages/4743954479"""
+            },
+            {
+                "keywords": printer_keywords,
+                "answer": """안녕하세요!
+사내 복합기 및 팩스 사용 방법을 안내해 드릴게요.
+
+🔄 복합기 설정 절차
+1. 복합기 계정을 등록해주세요.
+   - 🔗 계정 등록 링크: https://cloudmps.sindoh.com:8443/sparkplus/loginForm?clientLanguage=ko
+2. 필수 프로그램을 설치해주세요.
+   - 🔗 프로그램 설치 링크: https://cloudmps.sindoh.com:8443/sparkplus/loginForm?clientLanguage=ko
+3. 인증카드를 등록해주세요.
+   - 🔗 상세 가이드: https://sparkplus.oopy.io/373bbaf2-d7b0-4621-9e39-5aa630ba0757
+
+💡 자주 묻는 질문 (FAQ)
+- 인증카드: NFC 기능이 있는 스마트폰이나 교통카드 기능이 포함된 신용/체크카드를 사용할 수 있습니다.
+- 카드 재등록: 기기 변경이나 분실 시, 별도 해지 절차 없이 새로 등록하면 됩니다.
+- Mac 출력 오류: VPN(FortiClient) 또는 Logitech 관련 프로그램과 IP 충돌이 원인일 수 있습니다. 해당 프로그램을 종료한 후 다시 시도해보세요.
+
+더 궁금한 점이 있다면, 이 스레드에서 저를 멘션해주세요."""
+            }
+        ]
+        # 모든 키워드를 하나의 오토마톤으로 묶어 질문을 한 번만 훑습니다.
+        self.direct_answer_automaton = ahocorasick.Automaton()
+        for index, item in enumerate(self.direct_answers):
+            for keyword in item["keywords"]:
+                self.direct_answer_automaton.add_word(keyword.lower(), (index, keyword))
+        self.direct_answer_automaton.make_automaton()
+        logger.info("특정 질문에 대한 직접 답변(치트키) 설정 완료.")
+
+    def find_direct_answer(self, query):
+        """질문에 포함된 키워드가 한 가지 주제에만 해당하면 지정된 답변을 반환합니다."""
+        matched = {}
+        for _, (index, keyword) in self.direct_answer_automaton.iter(query.lower()):
+            matched.setdefault(index, keyword)
+        # 여러 주제가 섞인 질문은 AI가 판단하도록 넘깁니다.
+        if len(matched) != 1:
+            return None
+        index, keyword = matched.popitem()
+        logger.info(f"'{keyword}' 키워드를 감지하여 지정된 답변을 반환합니다.")
+        return self.direct_answers[index]["answer"]
+
+    def setup_gemini(self):
+        try:
+            gemini_api_key = os.environ.get("GEMINI_API_KEY")
+            # REST 전송은 백그라운드 스레드가 없어 --preload 이후 fork에도 안전합니다.
+            genai.configure(api_key=gemini_api_key, transport="rest")
+            model = genai.GenerativeModel(GEMINI_MODEL)
+            logger.info(f"Gemini API 활성화 완료. (모델: {GEMINI_MODEL})")
+            return model
+        except Exception as e:
+            logger.error(f"Gemini 모델 설정 실패: {e}")
+            return None
+
+    def build_classifier_model(self):
+        """질문 분류용 가벼운 모델을 만듭니다. GEMINI_CLASSIFIER_MODEL이 없으면 분류를 건너뜁니다."""
+        if not GEMINI_CLASSIFIER_MODEL or not self.gemini_model:
+            return None
+        logger.info(f"질문 분류 모델 활성화 완료. (모델: {GEMINI_CLASSIFIER_MODEL})")
+        return genai.GenerativeModel(GEMINI_CLASSIFIER_MODEL)
+
+    def load_knowledge_file(self):
+        try:
+            knowledge_base = read_text_file("guide_data.txt", self.knowledge_mtime)
+            logger.info(f"지식 파일 로드 완료. ({len(knowledge_base)}자)")
+            return knowledge_base
+        except FileNotFoundError:
+            logger.error("'guide_data.txt' 파일을 찾을 수 없습니다.")
+            return ""
+
+    def reload_files_if_changed(self):
+        """지식 파일이나 도움말 파일이 수정되었으면 다시 읽습니다. (재배포 없이 반영)"""
+        if time.monotonic() - self._knowledge_checked_at < KNOWLEDGE_CHECK_INTERVAL:
+            return
+        with self._knowledge_lock:
+            now = time.monotonic()
+            if now - self._knowledge_checked_at < KNOWLEDGE_CHECK_INTERVAL:
+                return
+            self._knowledge_checked_at = now
+            help_mtime = get_file_mtime("help.md")
+            if help_mtime != self.help_mtime:
+                self.help_mtime = help_mtime
+                self.help_text = self.load_help_file()
+                logger.info("도움말 파일 변경을 감지하여 다시 불러왔습니다.")
+            mtime = get_file_mtime("guide_data.txt")
+            if mtime == self.knowledge_mtime:
+                return
+            self.knowledge_mtime = mtime
+            # 네트워크 호출이 필요한 새 상태는 지역 변수로 먼저 모두 만들어 둡니다.
+            knowledge_base = self.load_knowledge_file()
+            kb_for_prompt = self.trim_knowledge_for_prompt(knowledge_base)
+            knowledge_index = self.build_knowledge_index(knowledge_base)
+            prompt_cache = self.create_prompt_cache(kb_for_prompt, knowledge_index)
+            cached_model = self.build_cached_model(prompt_cache)
+
+            self.knowledge_base = knowledge_base
+            self._kb_for_prompt = kb_for_prompt
+            self._prompt_prefix = self.build_prompt_prefix(kb_for_prompt)
+            self.knowledge_index = knowledge_index
+            with self._prompt_cache_lock:
+                self.swap_prompt_cache(prompt_cache, cached_model)
+            # 답변 캐시 키는 마지막에 바꿉니다. (이전 캐시로 만든 답변이 새 키로 저장되지 않도록)
+            self.knowledge_hash = self.hash_knowledge(knowledge_base, kb_for_prompt)
+            # 아직 이전 버전인 다른 워커가 쓰는 답변은 그 워커가 다시 읽을 때 정리됩니다.
+            self.answer_cache.prune(self.knowledge_hash)
+            logger.info("지식 파일 변경을 감지하여 다시 불러왔습니다.")
+
+    def load_help_file(self):
+        try:
+            help_text = read_text_file("help.md", self.help_mtime)
+            logger.info(f"도움말 파일 로드 완료. ({len(help_text)}자)")
+            return help_text
+        except FileNotFoundError:
+            logger.error("'help.md' 파일을 찾을 수 없습니다.")
+            return "도움말 파일을 찾을 수 없습니다."
+
+    def hash_knowledge(self, knowledge_base, kb_for_prompt):
+        """답변에 영향을 주는 입력(모델, 프롬프트, 지식 파일)의 해시입니다. 하나라도 바뀌면 이전 캐시 항목은 더 이상 맞지 않게 됩니다."""
+        answer_inputs = "\0".join([
+            GEMINI_MODEL, PROMPT_HEADER, PROMPT_QUESTION_HEADER, PROMPT_ANSWER_HEADER, PROMPT_BATCH_INSTRUCTION,
+            f"{RETRIEVAL_TOP_K}|{EMBEDDING_MODEL}|{CHUNK_SIZE}|{CHUNK_OVERLAP}", knowledge_base, kb_for_prompt,
+        ])
+        return hashlib.blake2b(answer_inputs.encode('utf-8'), digest_size=16).hexdigest()
+
+    def trim_knowledge_for_prompt(self, knowledge_base):
+        """지식 파일이 토큰 예산을 넘으면 섹션 단위로 줄인 프롬프트용 본문을 반환합니다."""
+        # 토큰 하나는 최소 1바이트이므로, 바이트 수가 예산 이하면 토큰 수를 셀 필요가 없습니다.
+        if (KNOWLEDGE_TOKEN_BUDGET <= 0 or not self.gemini_model
+                or len(knowledge_base.encode('utf-8')) <= KNOWLEDGE_TOKEN_BUDGET):
+            return knowledge_base
+        try:
+            total_tokens = self.gemini_model.count_tokens(knowledge_base).total_tokens
+        except Exception as e:
+            logger.warning(f"지식 파일 토큰 수 확인 실패, 전체를 사용합니다: {e}")
+            return knowledge_base
+        if total_tokens <= KNOWLEDGE_TOKEN_BUDGET:
+            return knowledge_base
+
+        # 섹션별 토큰 수는 전체 비율로 어림합니다. (섹션마다 API를 부르지 않도록)
+        tokens_per_char = total_tokens / len(knowledge_base)
+        # 파일이 "## "로 시작하면 맨 앞에 빈 조각이 생기므로 빼 둡니다.
+        sections = [section for section in re.split(r"(?m)^(?=## )", knowledge_base) if section]
+        kept, used = [], 0
+        for section in sections:
+            cost = len(section) * tokens_per_char
+            if used + cost > KNOWLEDGE_TOKEN_BUDGET:
+                continue
+            kept.append(section)
+            used += cost
+        if not kept:
+            # 예산 안에 드는 섹션이 하나도 없으면 참고 자료가 비지 않도록 앞부분을 글자 단위로 잘라 넣습니다.
+            logger.error(f"지식 파일의 모든 섹션이 토큰 예산({KNOWLEDGE_TOKEN_BUDGET})보다 커서 앞부분만 잘라 프롬프트에 넣습니다. (전체 {total_tokens}토큰)")
+            return knowledge_base[:int(KNOWLEDGE_TOKEN_BUDGET / tokens_per_char)]
+        logger.warning(f"지식 파일이 토큰 예산({KNOWLEDGE_TOKEN_BUDGET})을 넘어 섹션 {len(kept)}/{len(sections)}개만 프롬프트에 넣습니다. (전체 {total_tokens}토큰)")
+        return "".join(kept)
+
+    def build_prompt_prefix(self, kb_for_prompt):
+        """질문을 제외한 프롬프트 전체(역할, 원칙, 예시, 참고 자료)를 미리 조립합니다."""
+        return "".join([PROMPT_HEADER, kb_for_prompt, PROMPT_QUESTION_HEADER])
+
+    def setup_prompt_cache(self):
+        """질문 앞부분(역할, 원칙, 예시, 참고 자료)을 Gemini 서버에 새로 캐시합니다."""
+        prompt_cache = self.create_prompt_cache(self._kb_for_prompt, self.knowledge_index)
+        self.swap_prompt_cache(prompt_cache, self.build_cached_model(prompt_cache))
+
+    def swap_prompt_cache(self, prompt_cache, cached_model):
+        """새 서버 캐시로 바꾸고, 이 프로세스가 만든 이전 캐시는 지웁니다."""
+        (old_cache, _), old_pid = self._prompt_cache_state, self._prompt_cache_pid
+        self._prompt_cache_state = (prompt_cache, cached_model)
+        self._prompt_cache_pid = os.getpid()
+        # --preload로 마스터가 만든 캐시는 모든 워커가 함께 쓰므로 지우지 않고 TTL로 만료되게 둡니다.
+        if old_cache and old_pid == os.getpid():
+            try:
+                old_cache.delete()
+            except Exception as e:
+                logger.warning(f"이전 Gemini 컨텍스트 캐시 삭제 실패: {e}")
+
+    def create_prompt_cache(self, kb_for_prompt, knowledge_index):
+        # 검색 모드에서는 질문마다 참고 자료가 달라 캐시할 공통 부분이 없습니다.
+        if GEMINI_CACHE_TTL <= 0 or knowledge_index or not self.gemini_model or not kb_for_prompt:
+            return None
+        try:
+            cache = genai.caching.CachedContent.create(
+                model=GEMINI_MODEL,
+                display_name="people-ai-knowledge",
+                contents=[PROMPT_HEADER + kb_for_prompt],
+                ttl=datetime.timedelta(seconds=GEMINI_CACHE_TTL)
+            )
+            logger.info(f"Gemini 컨텍스트 캐시 생성 완료. ({cache.name})")
+            return cache
+        except Exception as e:
+            logger.error(f"Gemini 컨텍스트 캐시 생성 실패, 매 요청 전체 프롬프트를 보냅니다: {e}")
+            return None
+
+    def build_cached_model(self, prompt_cache):
+        if not prompt_cache:
+            return None
+        return genai.GenerativeModel.from_cached_content(prompt_cache)
+
+    def refresh_prompt_cache(self, prompt_cache):
+        """서버 캐시가 만료되기 전에 TTL을 연장합니다. 연장할 수 없으면(이미 만료 등) 새로 만듭니다."""
+        threshold = datetime.timedelta(seconds=GEMINI_CACHE_TTL / 4)
+        if prompt_cache.expire_time - datetime.datetime.now(datetime.timezone.utc) > threshold:
+            return
+        with self._prompt_cache_lock:
+            # 기다리는 동안 다른 스레드가 연장했거나, 지식 파일 재로드로 캐시가 바뀌었을 수 있습니다.
+            if self._prompt_cache_state[0] is not prompt_cache:
+                return
+            if prompt_cache.expire_time - datetime.datetime.now(datetime.timezone.utc) > threshold:
+                return
+            try:
+                prompt_cache.update(ttl=datetime.timedelta(seconds=GEMINI_CACHE_TTL))
+            except Exception as e:
+                logger.warning(f"Gemini 컨텍스트 캐시 연장 실패, 새로 만듭니다: {e}")
+                self.setup_prompt_cache()
+
+    def build_knowledge_index(self, knowledge_base):
+        """지식 파일 조각을 임베딩해 검색 인덱스(조각 목록, 정규화된 벡터 행렬)를 만듭니다."""
+        if RETRIEVAL_TOP_K <= 0 or not self.gemini_model or not knowledge_base:
+            return None
+        chunks = split_into_chunks(knowledge_base)
+        index_key = f"{EMBEDDING_MODEL}|{CHUNK_SIZE}|{CHUNK_OVERLAP}|{knowledge_base}"
+        index_name = hashlib.blake2b(index_key.encode('utf-8'), digest_size=16).hexdigest()
+        index_path = os.path.join(INDEX_CACHE_DIR, f"knowledge_index_{index_name}.npy")
+        try:
+            vectors = np.load(index_path)
+            if len(vectors) == len(chunks):
+                logger.info(f"저장된 지식 파일 검색 인덱스를 불러왔습니다. (조각 {len(chunks)}개)")
+                return chunks, vectors
+        except (OSError, ValueError):
+            pass
+        try:
+            result = genai.embed_content(model=EMBEDDING_MODEL, content=chunks, task_type="retrieval_document")
+            vectors = np.array(result["embedding"], dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            logger.info(f"지식 파일 검색 인덱스 생성 완료. (조각 {len(chunks)}개)")
+        except Exception as e:
+            logger.error(f"지식 파일 검색 인덱스 생성 실패, 전체 지식 파일을 사용합니다: {e}")
+            return None
+        try:
+            os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+            np.save(index_path, vectors)
+        except OSError as e:
+            logger.warning(f"지식 파일 검색 인덱스 저장 실패: {e}")
+        return chunks, vectors
+
+    def retrieve_knowledge(self, query):
+        """질문과 가장 관련 있는 지식 조각 top-k를 원문 순서대로 이어 붙여 반환합니다."""
+        chunks, vectors = self.knowledge_index
         try:
-            response = self.gemini_model.generate_content(prompt)
-            if not response.text.strip():
-                logger.warning("Gemini API가 비어있는 응답을 반환했습니다.")
-                return "답변을 생성하는 데 조금 시간이 걸리고 있어요. 다시 한 번 시도해주시겠어요?"
-            
-            logger.info(f"Gemini 답변 생성 성공. (쿼리: {query[:30]}...)")
-            return response.text
+            result = self.embedding_breaker.call(genai.embed_content, model=EMBEDDING_MODEL, content=query,
+                                                 task_type="retrieval_query", request_options={"timeout": EMBEDDING_TIMEOUT})
+        except CircuitOpenError:
+            return None
         except Exception as e:
+            logger.error(f"질문 임베딩 실패, 전체 지식 파일을 사용합니다: {e}")
+            return None
+        query_vector = np.array(result["embedding"], dtype=np.float32)
+        scores = vectors @ (query_vector / np.linalg.norm(query_vector))
+        top_indices = sorted(np.argsort(scores)[::-1][:RETRIEVAL_TOP_K])
+        return "\n...\n".join(chunks[i] for i in top_indices)
+
+    def build_request(self, query):
+        """질문에 보낼 (모델, 프롬프트)를 만듭니다. 검색 인덱스가 있으면 관련 조각만 참고 자료로 넣습니다."""
+        if self.knowledge_index:
+            context = self.retrieve_knowledge(query)
+            if context:
+                return self.gemini_model, "".join([PROMPT_HEADER, context, PROMPT_QUESTION_HEADER, query, PROMPT_ANSWER_HEADER])
+        return self.build_full_context_request(query + PROMPT_ANSWER_HEADER)
+
+    def build_full_context_request(self, question):
+        """지식 파일 전체를 참고하는 요청입니다. 서버 캐시가 있으면 질문 부분만 보냅니다."""
+        prompt_cache, cached_model = self._prompt_cache_state
+        if prompt_cache and cached_model:
+            self.refresh_prompt_cache(prompt_cache)
+            # 연장에 실패해 캐시를 새로 만들었으면 새 짝을 씁니다.
+            prompt_cache, cached_model = self._prompt_cache_state
+            if cached_model:
+                return cached_model, PROMPT_QUESTION_HEADER + question
+        return self.gemini_model, self._prompt_prefix + question
+
+    def extract_mention_query(self, text):
+        """봇이 멘션된 메시지면 멘션을 뺀 질문을, 아니면 None을 반환합니다."""
+        tag = self.mention_tag
+        if not tag:
+            return None
+        # 멘션 여부 확인과 제거를 한 번의 탐색으로 처리합니다.
+        index = text.find(tag)
+        if index == -1:
+            return None
+        # 슬랙은 멘션을 보통 메시지 맨 앞에 하나만 두므로 이때는 앞부분만 잘라냅니다.
+        if index == 0 and text.find(tag, len(tag)) == -1:
+            return text[len(tag):].strip()
+        # 멘션이 중간에 있거나 여러 번 들어간 경우는 미리 컴파일한 패턴으로 모두 지웁니다.
+        return self.mention_pattern.sub("", text).strip()
+
+    def generate_answer(self, query, on_partial=None, instant_checked=False):
+        """질문에 답변합니다. 호출하는 쪽이 이미 find_instant_answer로 확인했다면 instant_checked=True로 같은 조회를 건너뜁니다."""
+        if not instant_checked:
+            instant_answer = self.find_instant_answer(query)
+            if instant_answer: return instant_answer
+
+        if not self.gemini_model: return "AI 모델이 설정되지 않아 답변할 수 없습니다."
+        if not self.knowledge_base: return "지식 파일이 비어있어 답변할 수 없습니다."
+
+        cache_key = (self.knowledge_hash, normalize_query(query))
+        query_vector = self.embed_query_for_cache(query)
+        if query_vector is not None:
+            similar_answer = self.answer_cache.find_similar(cache_key[0], query_vector, SEMANTIC_CACHE_THRESHOLD)
+            if similar_answer:
+                ANSWER_CACHE_REQUESTS.labels(result="similar").inc()
+                logger.info(f"비슷한 질문의 캐시된 답변을 반환합니다. (쿼리: {query[:30]}...)")
+                return similar_answer
+        ANSWER_CACHE_REQUESTS.labels(result="miss").inc()
+
+        if self.is_off_topic(query):
+            logger.info(f"업무와 관련 없는 메시지로 분류되어 짧게 답변합니다. (쿼리: {query[:30]}...)")
+            return OFF_TOPIC_ANSWER
+
+        started_at = time.monotonic()
+        try:
+            # 검색 모드에서는 질문마다 참고 자료가 달라 묶을 수 없습니다.
+            if self.batcher and not self.knowledge_index:
+                answer = self.batcher.submit(query)
+            elif on_partial:
+                answer = self.stream_gemini(*self.build_request(query), on_partial)
+            else:
+                answer = self.call_gemini(*self.build_request(query))
+        except CircuitOpenError:
+            self.record_gemini_latency(time.monotonic() - started_at, "circuit_open")
+            logger.warning(f"Gemini 장애로 대체 답변을 반환합니다. (쿼리: {query[:30]}...)")
+            return "지금은 AI 답변이 원활하지 않아요. 피플팀에 직접 문의해주시면 빠르게 확인해 드릴게요."
+        except Exception as e:
+            self.record_gemini_latency(time.monotonic() - started_at, "error")
             logger.error(f"Gemini API 호출 실패: {e}", exc_info=True)
             return "음... 답변을 생성하는 도중 문제가 발생했어요. 잠시 후 다시 시도해보시겠어요? 😢"
 
+        if not answer.strip():
+            self.record_gemini_latency(time.monotonic() - started_at, "empty")
+            logger.warning("Gemini API가 비어있는 응답을 반환했습니다.")
+            return "답변을 생성하는 데 조금 시간이 걸리고 있어요. 다시 한 번 시도해주시겠어요?"
+
+        self.record_gemini_latency(time.monotonic() - started_at, "success")
+        logger.info(f"Gemini 답변 생성 성공. (쿼리: {query[:30]}...)")
+        self.answer_cache.set(cache_key, answer, query_vector)
+        return answer
+
+    def find_instant_answer(self, query):
+        """Gemini 없이 바로 줄 수 있는 답변(직접 답변, 캐시된 답변)이 있으면 반환합니다."""
+        self.reload_files_if_changed()
+        direct_answer = self.find_direct_answer(query)
+        if direct_answer:
+            return direct_answer
+        cached_answer = self.answer_cache.get((self.knowledge_hash, normalize_query(query)))
+        if cached_answer:
+            ANSWER_CACHE_REQUESTS.labels(result="hit").inc()
+            logger.info(f"캐시된 답변을 반환합니다. (쿼리: {query[:30]}...)")
+        return cached_answer
+
+    def record_gemini_latency(self, elapsed, outcome):
+        GEMINI_LATENCY.labels(outcome=outcome).observe(elapsed)
+        # 차단으로 바로 실패한 호출은 실제 응답 시간이 아니므로 평균에 넣지 않습니다.
+        if outcome == "circuit_open":
+            return
+        if self.gemini_latency_ewma is None:
+            self.gemini_latency_ewma = elapsed
+        else:
+            self.gemini_latency_ewma += LATENCY_EWMA_ALPHA * (elapsed - self.gemini_latency_ewma)
+
+    def expects_fast_answer(self):
+        """최근 Gemini 응답이 충분히 빨라 대기 메시지를 생략해도 되는지 판단합니다."""
+        return self.gemini_latency_ewma is not None and self.gemini_latency_ewma < FAST_ANSWER_THRESHOLD
+
+    def embed_query_for_cache(self, query):
+        """유사 질문 캐시가 켜져 있으면 질문의 정규화된 임베딩을 반환합니다."""
+        if SEMANTIC_CACHE_THRESHOLD <= 0:
+            return None
+        try:
+            result = self.embedding_breaker.call(genai.embed_content, model=EMBEDDING_MODEL, content=query,
+                                                 task_type="semantic_similarity", request_options={"timeout": EMBEDDING_TIMEOUT})
+        except CircuitOpenError:
+            return None
+        except Exception as e:
+            logger.error(f"캐시용 질문 임베딩 실패: {e}")
+            return None
+        vector = np.array(result["embedding"], dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def is_off_topic(self, query):
+        """분류 모델이 업무와 관련 없는 메시지라고 판단하면 True를 반환합니다. 분류에 실패하면 본 답변으로 넘깁니다."""
+        if not self.classifier_model:
+            return False
+        try:
+            # 분류 모델 장애 중에는 기다리지 않고 바로 건너뜁니다.
+            response = self.classifier_breaker.call(self.classifier_model.generate_content, PROMPT_CLASSIFIER + query,
+                                                    request_options={"timeout": GEMINI_CLASSIFIER_TIMEOUT})
+            return response.text.strip().upper().startswith("N")
+        except CircuitOpenError:
+            return False
+        except Exception as e:
+            logger.warning(f"질문 분류 실패, 본 답변으로 진행합니다: {e}")
+            return False
+
+    def call_gemini(self, model, prompt, generation_config=None):
+        """Gemini에 프롬프트를 보내고 답변 텍스트를 반환합니다."""
+        response = self.breaker.call(model.generate_content, prompt, generation_config=generation_config,
+                                     request_options={"timeout": GEMINI_TIMEOUT})
+        return response.text
+
+    def stream_gemini(self, model, prompt, on_partial):
+        """Gemini 응답을 스트리밍으로 받으며, 지금까지 받은 텍스트를 on_partial로 넘깁니다."""
+        def generate():
+            response = model.generate_content(prompt, stream=True, request_options={"timeout": GEMINI_TIMEOUT})
+            parts = []
+            for chunk in response:
+                try:
+                    parts.append(chunk.text)
+                except ValueError:
+                    # 텍스트 없이 종료 정보만 담긴 조각은 건너뜁니다.
+                    continue
+                on_partial("".join(parts))
+            return "".join(parts)
+        return self.breaker.call(generate)
+
+    def answer_batch(self, queries):
+        """여러 질문을 한 프롬프트로 묶어 물어보고 {번호: 답변}을 반환합니다."""
+        numbered = "\n".join(f"Q{number}: {query}" for number, query in enumerate(queries, 1))
+        model, prompt = self.build_full_context_request("".join([PROMPT_BATCH_INSTRUCTION, numbered, PROMPT_ANSWER_HEADER]))
+        answers = split_batch_answers(self.call_gemini(model, prompt, BATCH_GENERATION_CONFIG))
+        logger.info(f"질문 {len(queries)}개를 한 번의 Gemini 호출로 처리했습니다. (분리된 답변 {len(answers)}개)")
+        return answers
+
 bot = PeopleAIBot()
 
+def reset_gemini_after_fork():
+    """fork된 워커가 마스터의 Gemini 클라이언트 연결을 공유하지 않도록 새로 설정합니다."""
+    bot.gemini_model = bot.setup_gemini()
+    bot.classifier_model = bot.build_classifier_model()
+    prompt_cache, _ = bot._prompt_cache_state
+    bot._prompt_cache_state = (prompt_cache, bot.build_cached_model(prompt_cache))
+
+# gunicorn --preload: 지식 파일은 마스터에서 한 번만 읽고 워커는 fork로 메모리를 공유합니다.
+os.register_at_fork(after_in_child=reset_gemini_after_fork)
+
+# --- 중복 이벤트 차단 ---
+# 슬랙은 응답을 받지 못한 이벤트를 재전송하므로, 최근 처리한 event_id와 client_msg_id를 기억해 두고 건너뜁니다.
+# (슬랙 요청은 Bolt가 곧바로 ack하고, Gemini 호출은 listener_executor 스레드에서 처리됩니다.)
+SEEN_EVENT_LIMIT = 2048
+# 슬랙 재전송은 수 분 안에 끝나므로 그보다 오래된 기록은 버립니다.
+SEEN_EVENT_TTL = 300
+# 재전송은 아무 워커에나 도착하므로 처리 기록은 워커들이 함께 쓰는 SQLite 파일에 남깁니다. 빈 값이면 프로세스 메모리에만 둡니다.
+SEEN_EVENTS_PATH = os.environ.get("SEEN_EVENTS_PATH", ".cache/seen_events.sqlite3")
+_seen_events = OrderedDict()
+_seen_events_lock = threading.Lock()
+
+def init_seen_events_db():
+    """워커 공용 이벤트 기록 테이블을 만들고, 쓸 수 없으면 None을 반환합니다."""
+    if not SEEN_EVENTS_PATH:
+        return None
+    try:
+        os.makedirs(os.path.dirname(SEEN_EVENTS_PATH) or ".", exist_ok=True)
+        with closing(sqlite3.connect(SEEN_EVENTS_PATH, timeout=5)) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS seen_events (id TEXT PRIMARY KEY, seen_at REAL)")
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"이벤트 기록 파일을 열 수 없어 워커별 메모리로 중복을 확인합니다: {e}")
+        return None
+    return SEEN_EVENTS_PATH
+
+_seen_events_path = init_seen_events_db()
+
+def is_duplicate_event(*ids):
+    """주어진 id 중 최근에 처리한 것이 있으면 True를 반환하고, 없으면 모두 기록합니다."""
+    ids = [i for i in ids if i]
+    if not ids:
+        return False
+    if _seen_events_path:
+        try:
+            return check_shared_seen_events(ids)
+        except sqlite3.Error as e:
+            logger.warning(f"이벤트 기록 파일 확인 실패, 워커 메모리로 확인합니다: {e}")
+    now = time.monotonic()
+    with _seen_events_lock:
+        while _seen_events and now - next(iter(_seen_events.values())) > SEEN_EVENT_TTL:
+            _seen_events.popitem(last=False)
+        if any(i in _seen_events for i in ids):
+            return True
+        for i in ids:
+            _seen_events[i] = now
+        while len(_seen_events) > SEEN_EVENT_LIMIT:
+            _seen_events.popitem(last=False)
+    return False
+
+def check_shared_seen_events(ids):
+    """워커 공용 기록에서 중복 여부를 확인하고 기록합니다. 확인과 기록은 한 쓰기 트랜잭션으로 묶습니다."""
+    now = time.time()
+    with closing(sqlite3.connect(_seen_events_path, timeout=5, isolation_level=None)) as conn:
+        # BEGIN IMMEDIATE: 같은 재전송이 두 워커에 동시에 와도 한쪽만 기록에 성공합니다.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM seen_events WHERE seen_at < ?", (now - SEEN_EVENT_TTL,))
+            placeholders = ",".join("?" * len(ids))
+            duplicate = conn.execute(f"SELECT 1 FROM seen_events WHERE id IN ({placeholders})", ids).fetchone() is not None
+            if not duplicate:
+                conn.executemany("INSERT OR REPLACE INTO seen_events VALUES (?, ?)", [(i, now) for i in ids])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    return duplicate
+
+# 스트리밍 중 chat.update 기본 간격(초). 슬랙 chat.update 요청 한도를 넘지 않도록 합니다.
+SLACK_UPDATE_INTERVAL = 1.0
+# 새 글자가 SLACK_UPDATE_MIN_CHARS 이상 쌓이면 기본 간격 전이라도 갱신하되, 이 최소 간격(초)은 지킵니다.
+SLACK_UPDATE_MIN_INTERVAL = 0.5
+SLACK_UPDATE_MIN_CHARS = 200
+# 아직 답변을 작성 중임을 보여주는 커서입니다. 마지막 chat_update에서는 붙이지 않습니다.
+STREAMING_CURSOR = " ▍"
+
+def make_partial_updater(channel_id, ts):
+    """스트리밍 중간 결과로 대기 메시지를 갱신하는 콜백을 만듭니다."""
+    last_update = time.monotonic()
+    last_length = 0
+    def update(text):
+        nonlocal last_update, last_length
+        now = time.monotonic()
+        elapsed = now - last_update
+        if elapsed < SLACK_UPDATE_MIN_INTERVAL:
+            return
+        if elapsed < SLACK_UPDATE_INTERVAL and len(text) - last_length < SLACK_UPDATE_MIN_CHARS:
+            return
+        last_update = now
+        last_length = len(text)
+        try:
+            app.client.chat_update(channel=channel_id, ts=ts, text=text + STREAMING_CURSOR)
+        except Exception as e:
+            logger.warning(f"스트리밍 중간 결과 업데이트 실패: {e}")
+    return update
+
+def reply_with_answer(say, channel_id, thread_ts, query):
+    """스레드에 답변합니다. 곧바로 답할 수 있으면 대기 메시지 없이 한 번에 게시해 슬랙 API 호출을 줄입니다."""
+    instant_answer = bot.find_instant_answer(query)
+    if instant_answer:
+        say(text=instant_answer, thread_ts=thread_ts)
+        return
+    if bot.expects_fast_answer():
+        say(text=bot.generate_answer(query, instant_checked=True), thread_ts=thread_ts)
+        return
+
+    thinking_message = say(text=next(bot._searching_cycle), thread_ts=thread_ts)
+    final_answer = bot.generate_answer(query, on_partial=make_partial_updater(channel_id, thinking_message['ts']),
+                                       instant_checked=True)
+    final_update_client.chat_update(channel=channel_id, ts=thinking_message['ts'], text=final_answer)
+
 def handle_new_message(event, say):
     """스레드 밖의 새로운 메시지를 처리합니다."""
     channel_id = event.get("channel")
@@ -407,29 +1338,28 @@ def handle_new_message(event, say):
     if not text or len(text) < 2: return
 
     logger.info("새로운 메시지를 감지했습니다. 스레드를 시작하며 답변합니다.")
-    thinking_message = say(text=random.choice(bot.responses['searching']), thread_ts=message_ts)
-    final_answer = bot.generate_answer(text)
-    app.client.chat_update(channel=channel_id, ts=thinking_message['ts'], text=final_answer)
+    reply_with_answer(say, channel_id, message_ts, text)
 
 def handle_thread_reply(event, say):
     """스레드 내의 답글을 처리합니다."""
-    text = event.get("text", "")
-    if f"<@{bot.bot_id}>" in text:
+    clean_query = bot.extract_mention_query(event.get("text", ""))
+    if clean_query is not None:
         logger.info("스레드 내에서 멘션을 감지하여 응답합니다.")
         channel_id = event.get("channel")
         thread_ts = event.get("thread_ts")
-        clean_query = text.replace(f"<@{bot.bot_id}>", "").strip()
         if not clean_query: return
 
-        thinking_message = say(text=random.choice(bot.responses['searching']), thread_ts=thread_ts)
-        final_answer = bot.generate_answer(clean_query)
-        app.client.chat_update(channel=channel_id, ts=thinking_message['ts'], text=final_answer)
+        reply_with_answer(say, channel_id, thread_ts, clean_query)
 
-@app.event("message")
+# 수정/삭제/봇 메시지처럼 subtype이 있는 이벤트는 Bolt 매처 단계에서 걸러냅니다.
+@app.event({"type": "message", "subtype": None})
 def handle_all_message_events(body, say, logger):
     try:
         event = body["event"]
-        if "subtype" in event or (bot.bot_id and event.get("user") == bot.bot_id):
+        if bot.bot_id and event.get("user") == bot.bot_id:
+            return
+        if is_duplicate_event(body.get("event_id"), event.get("client_msg_id")):
+            logger.info(f"이미 처리한 이벤트({body.get('event_id')})가 재전송되어 건너뜁니다.")
             return
 
         text = event.get("text", "").strip()
@@ -439,6 +1369,7 @@ def handle_all_message_events(body, say, logger):
         if text == "도움말":
             logger.info(f"'{event.get('user')}' 사용자가 도움말을 요청했습니다.")
             reply_ts = thread_ts if thread_ts else message_ts
+            bot.reload_files_if_changed()
             say(text=bot.help_text, thread_ts=reply_ts)
             return
 
@@ -450,12 +1381,26 @@ def handle_all_message_events(body, say, logger):
     except Exception as e:
         logger.error(f"message 이벤트 처리 중 오류 발생: {e}", exc_info=True)
 
+@app.event("message")
+def ignore_message_subtypes():
+    """subtype이 있는 메시지 이벤트는 처리하지 않습니다. (미처리 요청으로 404가 나가지 않도록 등록)"""
+    pass
+
 @flask_app.route("/slack/events", methods=["POST"])
 def slack_events(): return handler.handle(request)
 
+@flask_app.route("/metrics", methods=["GET"])
+def metrics():
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
 @flask_app.route("/", methods=["GET"])
 def health_check(): return "피플AI (최종 버전) 정상 작동중! 🟢"
 
+# 로컬 개발 전용입니다. 운영 환경은 Procfile의 gunicorn으로 실행합니다.
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 3000))
     flask_app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,17 @@
+import os
+
+# --- gunicorn 설정 ---
+# Slack 웹훅 처리는 Gemini 응답을 기다리는 I/O 위주 작업이라 스레드 워커로 동시에 처리합니다.
+bind = f"0.0.0.0:{os.environ.get('PORT', 3000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+
+# 앱(지식 파일, 검색 인덱스, 컨텍스트 캐시)은 마스터에서 한 번만 만들고 워커는 fork로 공유합니다.
+preload_app = True
+
+def child_exit(server, worker):
+    # 멀티프로세스 메트릭을 쓰는 경우, 종료된 워커의 게이지 파일을 정리합니다.
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
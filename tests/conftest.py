@@ -0,0 +1,28 @@
+"""app 모듈을 슬랙·Gemini 없이 불러오기 위한 테스트 환경 설정입니다."""
+import os
+import sys
+
+from slack_sdk import WebClient
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.update({
+    "SLACK_BOT_TOKEN": "xoxb-test",
+    "SLACK_SIGNING_SECRET": "test-secret",
+    "GEMINI_API_KEY": "test-key",
+    "SLACK_BOT_ID": "UTESTBOT",
+    # 서버 캐시, 디스크 캐시를 만들지 않도록 끕니다.
+    "GEMINI_CACHE_TTL": "0",
+    "ANSWER_CACHE_PATH": "",
+    "SEEN_EVENTS_PATH": "",
+})
+
+# 앱을 불러오는 동안 슬랙 API(auth_test)를 부르면 실패하도록 막아 둡니다.
+def fail_auth_test(self, **kwargs):
+    raise AssertionError("앱 시작 중에 auth_test가 호출되었습니다.")
+
+WebClient.auth_test = fail_auth_test
+
+# app.py는 guide_data.txt, help.md를 현재 폴더 기준으로 읽습니다.
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
@@ -0,0 +1,542 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import numpy as np
+import pytest
+
+import app
+from app import AnswerCache, CircuitBreaker, CircuitOpenError, normalize_query, split_batch_answers, split_into_chunks
+
+
+def fail():
+    raise RuntimeError("boom")
+
+
+def trip(breaker):
+    for _ in range(breaker.fail_max):
+        with pytest.raises(RuntimeError):
+            breaker.call(fail)
+
+
+# --- CircuitBreaker ---
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(fail_max=2, reset_timeout=60)
+    trip(breaker)
+    calls = []
+    with pytest.raises(CircuitOpenError):
+        breaker.call(calls.append, 1)
+    assert calls == []
+
+
+def test_breaker_success_resets_failure_count():
+    breaker = CircuitBreaker(fail_max=2, reset_timeout=60)
+    with pytest.raises(RuntimeError):
+        breaker.call(fail)
+    assert breaker.call(lambda: "ok") == "ok"
+    with pytest.raises(RuntimeError):
+        breaker.call(fail)
+    # 연속 실패가 아니므로 아직 열리지 않습니다.
+    assert breaker.call(lambda: "ok") == "ok"
+
+
+def test_breaker_trial_call_success_closes():
+    breaker = CircuitBreaker(fail_max=2, reset_timeout=0.05)
+    trip(breaker)
+    time.sleep(0.06)
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.call(lambda: "again") == "again"
+
+
+def test_breaker_trial_call_failure_reopens():
+    breaker = CircuitBreaker(fail_max=2, reset_timeout=0.05)
+    trip(breaker)
+    time.sleep(0.06)
+    with pytest.raises(RuntimeError):
+        breaker.call(fail)
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: "ok")
+
+
+def test_breaker_allows_only_one_trial_call():
+    breaker = CircuitBreaker(fail_max=1, reset_timeout=0.05)
+    trip(breaker)
+    time.sleep(0.06)
+
+    def trial():
+        # 시험 호출이 진행 중일 때 들어온 호출은 계속 차단됩니다.
+        with pytest.raises(CircuitOpenError):
+            breaker.call(lambda: "blocked")
+        return "ok"
+
+    assert breaker.call(trial) == "ok"
+
+
+def test_breaker_open_error_names_the_breaker():
+    breaker = CircuitBreaker(fail_max=1, reset_timeout=60, name="질문 임베딩")
+    trip(breaker)
+    with pytest.raises(CircuitOpenError, match="질문 임베딩"):
+        breaker.call(lambda: "ok")
+
+
+def test_breaker_counts_failures_across_threads():
+    breaker = CircuitBreaker(fail_max=4, reset_timeout=60)
+
+    def failing_call(_):
+        with pytest.raises(RuntimeError):
+            breaker.call(fail)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(failing_call, range(4)))
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: "ok")
+
+
+# --- 묶음 응답 분리 ---
+
+def test_split_batch_answers_numbers_from_one():
+    assert split_batch_answers('["첫 번째 답변 ", "두 번째 답변"]') == {1: "첫 번째 답변", 2: "두 번째 답변"}
+
+
+def test_split_batch_answers_skips_empty_and_non_string_entries():
+    assert split_batch_answers('["a", "", 3, null, "e"]') == {1: "a", 5: "e"}
+
+
+@pytest.mark.parametrize("text", ["[[1]] 답변", '{"1": "답변"}', '"답변"', ""])
+def test_split_batch_answers_falls_back_on_malformed_output(text):
+    assert split_batch_answers(text) == {}
+
+
+# --- 지식 파일 조각 ---
+
+def test_split_into_chunks_overlaps_and_covers_text():
+    text = "".join(chr(ord("가") + i) for i in range(1200))
+    chunks = split_into_chunks(text, size=500, overlap=100)
+    assert [len(chunk) for chunk in chunks] == [500, 500, 400]
+    assert chunks[0][-100:] == chunks[1][:100]
+    assert chunks[-1].endswith(text[-1])
+
+
+def test_split_into_chunks_short_text_is_one_chunk():
+    assert split_into_chunks("짧은 글", size=500, overlap=100) == ["짧은 글"]
+
+
+# --- 질문 정규화 ---
+
+def test_normalize_query_ignores_case_whitespace_and_mentions():
+    assert normalize_query("<@U123ABC>  WiFi   비밀번호\n") == normalize_query("wifi 비밀번호")
+
+
+# --- 답변 캐시 ---
+
+def test_answer_cache_evicts_least_recently_used():
+    cache = AnswerCache(maxsize=2)
+    cache.set(("h", "a"), "A")
+    cache.set(("h", "b"), "B")
+    assert cache.get(("h", "a")) == "A"
+    cache.set(("h", "c"), "C")
+    assert cache.get(("h", "b")) is None
+    assert cache.get(("h", "a")) == "A"
+
+
+def test_answer_cache_find_similar_stays_within_knowledge_version():
+    cache = AnswerCache(maxsize=4)
+    cache.set(("old", "q"), "이전 답변", np.array([1.0, 0.0], dtype=np.float32))
+    cache.set(("new", "q"), "새 답변", np.array([0.0, 1.0], dtype=np.float32))
+    assert cache.find_similar("old", np.array([1.0, 0.0], dtype=np.float32), 0.9) == "이전 답변"
+    assert cache.find_similar("new", np.array([1.0, 0.0], dtype=np.float32), 0.9) is None
+
+
+def test_answer_cache_persists_across_instances(tmp_path):
+    path = str(tmp_path / "answers.sqlite3")
+    AnswerCache(maxsize=2, path=path).set(("h", "q"), "저장된 답변")
+    assert AnswerCache(maxsize=2, path=path).get(("h", "q")) == "저장된 답변"
+
+
+def test_answer_cache_keeps_only_maxsize_rows_on_disk(tmp_path):
+    path = str(tmp_path / "answers.sqlite3")
+    cache = AnswerCache(maxsize=2, path=path)
+    for query in "abc":
+        cache.set(("h", query), query.upper())
+    fresh = AnswerCache(maxsize=2, path=path)
+    assert [fresh.get(("h", query)) for query in "abc"] == [None, "B", "C"]
+
+
+def test_answer_cache_prune_drops_other_knowledge_versions(tmp_path):
+    path = str(tmp_path / "answers.sqlite3")
+    cache = AnswerCache(maxsize=4, path=path)
+    cache.set(("old", "q"), "이전 답변")
+    cache.set(("new", "q"), "새 답변")
+    cache.prune("new")
+    fresh = AnswerCache(maxsize=4, path=path)
+    assert fresh.get(("old", "q")) is None
+    assert fresh.get(("new", "q")) == "새 답변"
+
+
+# --- 중복 이벤트 차단 ---
+
+def test_is_duplicate_event_matches_any_known_id():
+    assert not app.is_duplicate_event("Ev-test-1", "msg-test-1")
+    assert app.is_duplicate_event("Ev-test-2", "msg-test-1")
+    assert not app.is_duplicate_event(None, None)
+
+
+# --- 질문 분류 ---
+
+class BrokenModel:
+    def generate_content(self, *args, **kwargs):
+        raise RuntimeError("classifier down")
+
+
+def test_classifier_failures_do_not_open_the_answer_breaker(monkeypatch):
+    bot = app.bot
+    monkeypatch.setattr(bot, "classifier_model", BrokenModel())
+    monkeypatch.setattr(bot, "breaker", CircuitBreaker(fail_max=2, reset_timeout=60))
+    monkeypatch.setattr(bot, "classifier_breaker", CircuitBreaker(fail_max=2, reset_timeout=60, name="질문 분류"))
+    for _ in range(5):
+        assert bot.is_off_topic("와이파이가 자꾸 끊겨요") is False
+    assert bot.breaker.call(lambda: "answer") == "answer"
+    with pytest.raises(CircuitOpenError):
+        bot.classifier_breaker.call(lambda: "Y")
+
+
+# --- 임베딩 ---
+
+def broken_embed_content(**kwargs):
+    raise RuntimeError("embedding down")
+
+
+@pytest.fixture
+def broken_embeddings(monkeypatch):
+    bot = app.bot
+    monkeypatch.setattr(app.genai, "embed_content", broken_embed_content)
+    monkeypatch.setattr(bot, "breaker", CircuitBreaker(fail_max=2, reset_timeout=60))
+    monkeypatch.setattr(bot, "embedding_breaker", CircuitBreaker(fail_max=2, reset_timeout=60, name="질문 임베딩"))
+    return bot
+
+
+def test_retrieval_embedding_failures_do_not_open_the_answer_breaker(monkeypatch, broken_embeddings):
+    bot = broken_embeddings
+    monkeypatch.setattr(bot, "knowledge_index", (["조각"], np.ones((1, 2), dtype=np.float32)))
+    for _ in range(5):
+        assert bot.retrieve_knowledge("질문") is None
+    assert bot.breaker.call(lambda: "answer") == "answer"
+
+
+def test_cache_embedding_failures_do_not_open_the_answer_breaker(monkeypatch, broken_embeddings):
+    bot = broken_embeddings
+    monkeypatch.setattr(app, "SEMANTIC_CACHE_THRESHOLD", 0.9)
+    for _ in range(5):
+        assert bot.embed_query_for_cache("질문") is None
+    assert bot.breaker.call(lambda: "answer") == "answer"
+
+
+# --- 봇 ID 캐시 ---
+
+@pytest.fixture
+def bot_id_cache(monkeypatch, tmp_path):
+    monkeypatch.delenv("SLACK_BOT_ID")
+    monkeypatch.setattr(app, "INDEX_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "BOT_ID_CACHE_FILE", str(tmp_path / "bot_id_test"))
+    calls = []
+
+    def auth_test(**kwargs):
+        calls.append(kwargs)
+        return {"user_id": "UFROMSLACK"}
+
+    monkeypatch.setattr(app.app.client, "auth_test", auth_test)
+    return tmp_path / "bot_id_test", calls
+
+
+def test_load_bot_id_uses_fresh_cache_without_auth_test(bot_id_cache):
+    path, calls = bot_id_cache
+    path.write_text("UCACHED", encoding="utf-8")
+    assert app.bot.load_bot_id() == "UCACHED"
+    assert calls == []
+
+
+def test_load_bot_id_refreshes_expired_cache(bot_id_cache):
+    path, calls = bot_id_cache
+    path.write_text("UCACHED", encoding="utf-8")
+    expired = time.time() - app.BOT_ID_CACHE_TTL - 1
+    os.utime(path, (expired, expired))
+    assert app.bot.load_bot_id() == "UFROMSLACK"
+    assert len(calls) == 1
+    assert path.read_text(encoding="utf-8") == "UFROMSLACK"
+
+
+def test_load_bot_id_falls_back_when_cache_is_unreadable(bot_id_cache):
+    path, calls = bot_id_cache
+    path.write_bytes(b"\xff\xfe")
+    assert app.bot.load_bot_id() == "UFROMSLACK"
+    assert len(calls) == 1
+
+
+# --- 묶음 처리 ---
+
+class StubBatchBot:
+    """묶음 호출은 answered에 든 질문만 답하고(None이면 실패하고), 개별 호출은 delay초 걸리는 봇입니다."""
+    def __init__(self, answered=None, delay=0.2):
+        self.answered = answered
+        self.delay = delay
+
+    def answer_batch(self, queries):
+        if self.answered is None:
+            raise RuntimeError("batch failed")
+        return {number: f"묶음 답변: {query}" for number, query in enumerate(queries, 1) if query in self.answered}
+
+    def build_request(self, query):
+        return None, query
+
+    def call_gemini(self, model, prompt):
+        time.sleep(self.delay)
+        return f"개별 답변: {prompt}"
+
+
+def submit_all(batcher, queries):
+    with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+        return list(pool.map(batcher.submit, queries))
+
+
+def test_batcher_falls_back_to_parallel_single_calls():
+    batcher = app.GeminiBatcher(StubBatchBot(), window=0.05)
+    queries = [f"질문{i}" for i in range(6)]
+    started_at = time.monotonic()
+    answers = submit_all(batcher, queries)
+    elapsed = time.monotonic() - started_at
+    assert answers == [f"개별 답변: {query}" for query in queries]
+    # 하나씩 차례로 호출하면 6 × 0.2초가 걸립니다.
+    assert elapsed < 0.6
+
+
+def test_batcher_submit_times_out_when_dispatch_is_stuck():
+    batcher = app.GeminiBatcher(StubBatchBot(delay=1), window=0.01)
+    batcher.result_timeout = 0.1
+    with pytest.raises(FutureTimeoutError):
+        batcher.submit("질문")
+
+
+def test_batcher_only_retries_questions_missing_from_the_batch():
+    batcher = app.GeminiBatcher(StubBatchBot(answered={"질문1", "질문3"}), window=0.05)
+    answers = submit_all(batcher, ["질문1", "질문2", "질문3"])
+    assert answers == ["묶음 답변: 질문1", "개별 답변: 질문2", "묶음 답변: 질문3"]
+
+
+def test_malformed_batch_json_falls_back_for_every_question(monkeypatch):
+    bot = app.bot
+
+    def call_gemini(model, prompt, generation_config=None):
+        if generation_config == app.BATCH_GENERATION_CONFIG:
+            return '["첫 답변", "둘째 답변"'
+        time.sleep(0.2)
+        return "개별 답변"
+
+    monkeypatch.setattr(bot, "call_gemini", call_gemini)
+    batcher = app.GeminiBatcher(bot, window=0.05)
+    started_at = time.monotonic()
+    assert submit_all(batcher, ["질문1", "질문2", "질문3", "질문4"]) == ["개별 답변"] * 4
+    assert time.monotonic() - started_at < 0.6
+
+
+# --- 스트리밍 중간 갱신 ---
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def chat_updates(monkeypatch):
+    updates = []
+    monkeypatch.setattr(app.app.client, "chat_update", lambda **kwargs: updates.append(kwargs["text"]))
+    return updates
+
+
+def test_partial_updater_throttles_by_time_and_size(monkeypatch, chat_updates):
+    clock = FakeClock()
+    monkeypatch.setattr(app.time, "monotonic", clock)
+    update = app.make_partial_updater("C1", "1.0")
+
+    clock.now = 0.3
+    update("가" * 300)  # 글자는 충분하지만 최소 간격 전
+    clock.now = 0.6
+    update("가" * 300)  # 최소 간격이 지났고 200자 이상 쌓임
+    clock.now = 0.8
+    update("가" * 350)  # 새 글자 50자, 기본 간격 전
+    clock.now = 1.7
+    update("가" * 360)  # 기본 간격이 지남
+
+    assert chat_updates == ["가" * 300 + app.STREAMING_CURSOR, "가" * 360 + app.STREAMING_CURSOR]
+
+
+def test_final_answer_is_posted_with_the_retrying_client(monkeypatch, chat_updates):
+    bot = app.bot
+    final_updates = []
+    monkeypatch.setattr(bot, "find_instant_answer", lambda query: None)
+    monkeypatch.setattr(bot, "expects_fast_answer", lambda: False)
+    monkeypatch.setattr(bot, "generate_answer", lambda query, on_partial=None, instant_checked=False: "최종 답변")
+    monkeypatch.setattr(app.final_update_client, "chat_update", lambda **kwargs: final_updates.append(kwargs["text"]))
+    app.reply_with_answer(lambda **kwargs: {"ts": "2.0"}, "C1", "1.0", "질문")
+    assert final_updates == ["최종 답변"]
+    assert chat_updates == []
+
+
+# --- 즉시 답변 ---
+
+def test_reply_looks_up_instant_answers_only_once(monkeypatch):
+    bot = app.bot
+    lookups = []
+    monkeypatch.setattr(bot, "find_direct_answer", lambda query: lookups.append(query))
+    monkeypatch.setattr(bot, "expects_fast_answer", lambda: True)
+    monkeypatch.setattr(bot, "answer_cache", AnswerCache(maxsize=2))
+    monkeypatch.setattr(bot, "call_gemini", lambda model, prompt, generation_config=None: "Gemini 답변")
+    monkeypatch.setattr(bot, "batcher", None)
+    posted = []
+    app.reply_with_answer(lambda **kwargs: posted.append(kwargs["text"]), "C1", "1.0", "연차는 어떻게 쓰나요")
+    assert posted == ["Gemini 답변"]
+    assert lookups == ["연차는 어떻게 쓰나요"]
+
+
+# --- Gemini 컨텍스트 캐시 ---
+
+def test_full_context_request_survives_cache_swap_during_refresh(monkeypatch):
+    bot = app.bot
+
+    class ExpiringCache:
+        @property
+        def expire_time(self):
+            # 만료 시각을 확인하는 사이 다른 스레드의 재로드가 캐시를 없앤 상황입니다.
+            bot._prompt_cache_state = (None, None)
+            return app.datetime.datetime.now(app.datetime.timezone.utc)
+
+    monkeypatch.setattr(bot, "_prompt_cache_state", (ExpiringCache(), "cached-model"))
+    monkeypatch.setattr(app, "GEMINI_CACHE_TTL", 3600)
+    model, prompt = bot.build_full_context_request("질문")
+    assert model is bot.gemini_model
+    assert prompt == bot._prompt_prefix + "질문"
+
+
+# --- 워커 공용 중복 이벤트 기록 ---
+
+@pytest.fixture
+def shared_seen_events(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "SEEN_EVENTS_PATH", str(tmp_path / "seen_events.sqlite3"))
+    monkeypatch.setattr(app, "_seen_events_path", app.init_seen_events_db())
+    assert app._seen_events_path
+
+
+def mark_events(prefix):
+    return sum(not app.is_duplicate_event(f"{prefix}-{number}") for number in range(50))
+
+
+def test_shared_seen_events_detects_duplicates_by_any_id(shared_seen_events):
+    assert not app.is_duplicate_event("Ev-shared-1", "msg-shared-1")
+    assert app.is_duplicate_event("Ev-shared-2", "msg-shared-1")
+    assert app.is_duplicate_event("Ev-shared-1")
+    # 공용 기록을 쓰므로 워커 메모리에는 남기지 않습니다.
+    assert "Ev-shared-1" not in app._seen_events
+
+
+def test_shared_seen_events_expire_after_ttl(monkeypatch, shared_seen_events):
+    assert not app.is_duplicate_event("Ev-ttl")
+    real_time = time.time
+    monkeypatch.setattr(app.time, "time", lambda: real_time() + app.SEEN_EVENT_TTL + 1)
+    assert not app.is_duplicate_event("Ev-ttl")
+
+
+def test_shared_seen_events_are_shared_across_processes(shared_seen_events):
+    with multiprocessing.get_context("fork").Pool(4) as pool:
+        accepted = pool.map(mark_events, ["Ev-fork"] * 4)
+    assert sum(accepted) == 50
+
+
+# --- 직접 답변 ---
+
+@pytest.mark.parametrize("query", ["와이파이 비밀번호 알려주세요", "WiFi PW 뭐예요?", "wi-fi 연결 방법", "와이파이비번"])
+def test_wifi_lookups_get_the_direct_answer(query):
+    assert "joonggonara-5G" in app.bot.find_direct_answer(query)
+
+
+@pytest.mark.parametrize("query", ["복합기 계정 등록은 어떻게 하나요", "복합기 사용법 알려주세요", "복합기 인증카드 바꿨어요"])
+def test_printer_lookups_get_the_direct_answer(query):
+    assert "복합기 설정 절차" in app.bot.find_direct_answer(query)
+
+
+@pytest.mark.parametrize("query", ["와이파이가 자꾸 끊겨요", "복합기 종이 걸렸어요", "wifi 너무 느려요"])
+def test_troubleshooting_questions_go_to_gemini(query):
+    assert app.bot.find_direct_answer(query) is None
+
+
+def test_questions_matching_several_topics_go_to_gemini():
+    assert app.bot.find_direct_answer("외부 회의실 와이파이 비밀번호도 같나요?") is None
+
+
+# --- 멘션 처리 ---
+
+def test_extract_mention_query_strips_a_leading_mention():
+    assert app.bot.extract_mention_query("<@UTESTBOT> 연차 신청 방법") == "연차 신청 방법"
+
+
+def test_extract_mention_query_ignores_messages_without_the_bot_mention():
+    assert app.bot.extract_mention_query("연차 신청 방법") is None
+    assert app.bot.extract_mention_query("<@UOTHER> 연차 신청 방법") is None
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("연차 신청은 <@UTESTBOT> 어디서 하나요", "연차 신청은  어디서 하나요"),
+    ("<@UTESTBOT> <@UTESTBOT> 연차 신청 방법", "연차 신청 방법"),
+    ("<@UTESTBOT>", ""),
+])
+def test_extract_mention_query_strips_mid_text_and_repeated_mentions(text, expected):
+    assert app.bot.extract_mention_query(text) == expected
+
+
+# --- 지식 파일 토큰 예산 ---
+
+class CharTokenModel:
+    """글자 하나를 토큰 하나로 세는 가짜 모델입니다."""
+    def __init__(self):
+        self.calls = 0
+
+    def count_tokens(self, text):
+        self.calls += 1
+        return type("CountTokensResponse", (), {"total_tokens": len(text)})()
+
+
+@pytest.fixture
+def token_model(monkeypatch):
+    model = CharTokenModel()
+    monkeypatch.setattr(app.bot, "gemini_model", model)
+    monkeypatch.setattr(app, "KNOWLEDGE_TOKEN_BUDGET", 100)
+    return model
+
+
+def test_trim_keeps_small_files_without_counting_tokens(token_model):
+    assert app.bot.trim_knowledge_for_prompt("짧은 지식") == "짧은 지식"
+    assert token_model.calls == 0
+
+
+def test_trim_keeps_whole_sections_that_fit(token_model):
+    intro, big, small = "a" * 30 + "\n", "## 큰 섹션\n" + "b" * 200 + "\n", "## 작은 섹션\n" + "c" * 40 + "\n"
+    assert app.bot.trim_knowledge_for_prompt(intro + big + small) == intro + small
+
+
+def test_trim_falls_back_to_a_prefix_when_no_section_fits(token_model):
+    knowledge_base = "## 첫 섹션\n" + "가" * 300 + "\n## 둘째 섹션\n" + "나" * 300
+    trimmed = app.bot.trim_knowledge_for_prompt(knowledge_base)
+    assert trimmed == knowledge_base[:100]
+
+
+def test_trim_uses_the_whole_file_when_counting_fails(monkeypatch, token_model):
+    def count_tokens(text):
+        raise RuntimeError("count_tokens failed")
+
+    monkeypatch.setattr(token_model, "count_tokens", count_tokens)
+    knowledge_base = "## 섹션\n" + "가" * 300
+    assert app.bot.trim_knowledge_for_prompt(knowledge_base) == knowledge_base